@@ -0,0 +1,151 @@
+import configparser
+from dataclasses import dataclass
+import functools
+import itertools
+import os
+import subprocess
+import threading
+from datetime import datetime, timedelta
+
+import boto3
+import botocore.config
+
+@dataclass(slots=True, frozen=True)
+class EC2InstanceConfig:
+    id: str
+    display_name: str
+    user: str
+    directory: str | None
+
+
+@dataclass(slots=True, frozen=True)
+class EC2InstanceStatus:
+    config: EC2InstanceConfig
+    id: str
+    name: str
+    state: str
+    public_ip: str | None
+    launch_time: datetime | None
+
+
+EC2InstanceConfigCollection = dict[str, EC2InstanceConfig]
+EC2InstanceStatusCollection = dict[str, EC2InstanceStatus]
+EC2InstanceStatusSnapshot = tuple[EC2InstanceStatus, ...]
+
+def get_ec2_instance_configs(ini_path) -> EC2InstanceConfigCollection:
+    if not os.path.exists(ini_path):
+        raise FileNotFoundError(f"{ini_path} not found")
+    # 同じファイルが変更されていなければ前回の解析結果を使う
+    return _parse_ec2_instance_configs(ini_path, os.stat(ini_path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_ec2_instance_configs(ini_path, mtime_ns) -> EC2InstanceConfigCollection:
+    ini = configparser.ConfigParser()
+    instances: EC2InstanceConfigCollection = {}
+    with open(ini_path) as f:
+        ini.read_file(f)
+        for section_name in ini.sections():
+            section = ini[section_name]
+            id = section.get('id')
+            if not id:
+                continue
+            instances[id] = EC2InstanceConfig(
+                id = id,
+                display_name = section_name,
+                user = section.get('user', 'ec2-user'),
+                directory = section.get('directory', None)
+            )
+    return instances
+
+
+# boto3 のクライアントは、リージョンや認証情報が解決できなくても --help などが動くよう、
+# 最初に使うときに作ってスレッド間で共有する
+_ec2_client = None
+_ec2_client_lock = threading.Lock()
+
+def _ec2():
+    global _ec2_client
+    with _ec2_client_lock:
+        if _ec2_client is None:
+            _ec2_client = boto3.client('ec2', config=botocore.config.Config(
+                max_pool_connections=10,
+                retries={'mode': 'adaptive'}
+            ))
+        return _ec2_client
+
+
+def get_ec2_instance_states(config: EC2InstanceConfigCollection) -> EC2InstanceStatusCollection:
+    # InstanceIds が空だと全インスタンスが返ってきてしまう
+    if not config:
+        return {}
+
+    instance_ids = list(config.keys())
+    pages = _ec2().get_paginator('describe_instances').paginate(InstanceIds=instance_ids)
+    reservations = itertools.chain.from_iterable(page['Reservations'] for page in pages)
+
+    instances: EC2InstanceStatusCollection = {}
+    for reservation in reservations:
+        for item in reservation['Instances']:
+            id = item['InstanceId']
+            config_item = config[id]
+            name = next((tag['Value'] for tag in item.get('Tags', []) if tag['Key'] == 'Name'), None)
+            state = item['State']['Name']
+            # boto3 は LaunchTime をタイムゾーン付きの datetime で返すので、そのまま使える
+            launch_time = item['LaunchTime'] if state == 'running' else None
+            instances[id] = EC2InstanceStatus(
+                config = config_item,
+                id = id,
+                name = name if name else config_item.display_name,
+                state = state,
+                public_ip = item.get('PublicIpAddress'),
+                launch_time = launch_time
+            )
+    return instances
+
+
+_instance_actions = {
+    'start': ('start_instances', 'instance_running'),
+    'stop': ('stop_instances', 'instance_stopped'),
+}
+
+def send_instance_action(action: str, instance_ids: list[str]):
+    method, _ = _instance_actions[action]
+    getattr(_ec2(), method)(InstanceIds=instance_ids)
+
+
+def wait_for_instance_action(action: str, instance_ids: list[str]):
+    _, waiter_name = _instance_actions[action]
+    _ec2().get_waiter(waiter_name).wait(
+        InstanceIds=instance_ids,
+        WaiterConfig={'Delay': 5, 'MaxAttempts': 24}
+    )
+
+
+def open_vscode_remote_ssh(instance: EC2InstanceStatus):
+    command = [
+        'code', '--new-window', '--remote',
+        f'ssh-remote+{instance.config.user}@{instance.public_ip}'
+    ]
+    if instance.config.directory:
+        command.append(instance.config.directory)
+    # VSCode の終了を待つ必要はないので、起動だけして戻る
+    subprocess.Popen(command)
+
+
+def possible_actions(instance: EC2InstanceStatus):
+    actions = dict(start=False, stop=False, vscode=False)
+    if instance.state == 'running':
+        actions['stop'] = True
+        if instance.public_ip:
+            actions['vscode'] = True
+    if instance.state == 'stopped':
+        actions['start'] = True
+    return actions
+
+def format_elapsed_time(t: timedelta | None) -> str:
+    if t is None:
+        return ''
+    hours, remainder = divmod(t.total_seconds(), 3600)
+    minutes, second = divmod(remainder, 60)
+    return f"{int(hours)}:{int(minutes):02}:{int(second):02}"
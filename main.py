@@ -1,217 +1,239 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections import OrderedDict
-import configparser
-from dataclasses import dataclass
-import os
-import subprocess
-import json
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+import random
 import threading
-import time
+import traceback
 import tkinter as tk
 from tkinter import ttk
 
-@dataclass
-class EC2InstanceConfig:
-    id: str
-    display_name: str
-    user: str
-    directory: str | None
-
-
-@dataclass
-class EC2InstanceStatus:
-    config: EC2InstanceConfig
-    id: str
-    name: str
-    state: str
-    public_ip: str | None
-    elapsed_time: timedelta | None
-
-
-EC2InstanceConfigCollection = OrderedDict[str, EC2InstanceConfig]
-EC2InstanceStatusCollection = OrderedDict[str, EC2InstanceStatus]
-
-def get_ec2_instance_configs(ini_path) -> EC2InstanceConfigCollection:
-    if not os.path.exists(ini_path):
-        raise FileNotFoundError(f"{ini_path} not found")
-
-    ini = configparser.ConfigParser()
-    instances: EC2InstanceConfigCollection = OrderedDict()
-    with open(ini_path) as f:
-        ini.read_file(f)
-        for section_name in ini.sections():
-            section = ini[section_name]
-            id = section.get('id')
-            if not id:
-                continue
-            instances[id] = EC2InstanceConfig(
-                id = id,
-                display_name = section_name,
-                user = section.get('user', 'ec2-user'),
-                directory = section.get('directory', None)
-            )
-    return instances
-
-
-def get_ec2_instance_states(config: EC2InstanceConfigCollection) -> EC2InstanceStatusCollection:
-    instance_ids = config.keys()
-    command = [
-        'aws', 'ec2', 'describe-instances',
-        '--instance-ids', *instance_ids,
-        '--query', "Reservations[*].Instances[*].[InstanceId, Tags[?Key=='Name'].Value | [0], State.Name, PublicIpAddress, LaunchTime]",
-        '--output', 'json'
-    ]
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(result.stderr)
-    out = json.loads(result.stdout)
-
-    instances: EC2InstanceStatusCollection = OrderedDict()
-    current_time = datetime.now(timezone.utc)
-    for reservation in out:
-        for items in reservation:
-            id = items[0]
-            config_item = config[id]
-            launch_time = datetime.strptime(items[4], '%Y-%m-%dT%H:%M:%S%z').replace(tzinfo=timezone.utc)
-            state = items[2]
-            elapsed_time = current_time - launch_time if state == 'running' else None
-            instances[id] = EC2InstanceStatus(
-                config = config_item,
-                id = id,
-                name = items[1] if items[1] else config_item.display_name,
-                state = state,
-                public_ip = items[3] if items[3] else None,
-                elapsed_time = elapsed_time
-            )
-    return instances
-
-
-def _send_command(command):
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(result.stderr)
-    out = json.loads(result.stdout)
-    for item in out:
-        # TODO このタイミングでビューに変化を起こしたいところだけど、もっと変数のまとまりを整理してから
-        print(f"{item[0]} is {item[1]}")
-
-def start_ec2_instance(instance: EC2InstanceStatus):
-    _send_command([
-        'aws', 'ec2', 'start-instances',
-        '--instance-ids', instance.config.id,
-        '--query', "StartingInstances[*].[InstanceId, CurrentState.Name]",
-        '--output', 'json'
-    ])
-    burst_status_watching()
-
-
-def stop_ec2_instance(instance: EC2InstanceStatus):
-    _send_command([
-        'aws', 'ec2', 'stop-instances',
-        '--instance-ids', instance.config.id,
-        '--query', "StoppingInstances[*].[InstanceId, CurrentState.Name]",
-        '--output', 'json'
-    ])
-    burst_status_watching()
-
-
-def open_vscode_remote_ssh(instance: EC2InstanceStatus):
-    command = [
-        'code', '--new-window', '--remote',
-        f'ssh-remote+{instance.config.user}@{instance.public_ip}'
-    ]
-    if instance.config.directory:
-        command.append(instance.config.directory)
-    subprocess.run(command)
-
-
-def possible_actions(instance: EC2InstanceStatus):
-    actions = dict(start=False, stop=False, vscode=False)
-    if instance.state == 'running':
-        actions['stop'] = True
-        if instance.public_ip:
-            actions['vscode'] = True
-    if instance.state == 'stopped':
-        actions['start'] = True
-    return actions
-
-def format_elapsed_time(t: timedelta | None) -> str:
-    if t is None:
-        return ''
-    hours, remainder = divmod(t.total_seconds(), 3600)
-    minutes, second = divmod(remainder, 60)
-    return f"{int(hours)}:{int(minutes):02}:{int(second):02}"
-
+from ec2_power.core import (
+    EC2InstanceConfigCollection,
+    EC2InstanceStatus,
+    EC2InstanceStatusCollection,
+    EC2InstanceStatusSnapshot,
+    format_elapsed_time,
+    get_ec2_instance_configs,
+    get_ec2_instance_states,
+    open_vscode_remote_ssh,
+    possible_actions,
+    send_instance_action,
+    wait_for_instance_action,
+)
+
+_pending_instance_ids: dict[str, list[str]] = {'start': [], 'stop': []}
+# 状態遷移をウェイターで待っている数。Tk のスレッドからだけ読み書きする
+_active_waiters = 0
+
+def _queue_instance_action(action: str, instance_id: str, tree: ttk.Treeview, on_change, delay_ms=300):
+    pending = _pending_instance_ids[action]
+    if not pending:
+        tree.after(delay_ms, lambda: _flush_instance_action(action, tree, on_change))
+    if instance_id not in pending:
+        pending.append(instance_id)
+
+
+def _flush_instance_action(action: str, tree: ttk.Treeview, on_change):
+    global _active_waiters
+    instance_ids = list(_pending_instance_ids[action])
+    _pending_instance_ids[action].clear()
+    _active_waiters += 1
+
+    def finish():
+        global _active_waiters
+        _active_waiters -= 1
+        on_change()
+
+    # API の呼び出しと状態遷移の待機は、UI を止めないよう別スレッドで行う
+    def worker():
+        try:
+            send_instance_action(action, instance_ids)
+            on_change()
+            wait_for_instance_action(action, instance_ids)
+        except Exception:
+            # まとめて送ったうちの 1 台でも状態が合わないと全体が失敗するので、
+            # 記録だけして、実際の状態は次の更新で表示に反映させる
+            traceback.print_exc()
+        post_to_tk(tree, finish)
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def start_ec2_instance(instance: EC2InstanceStatus, tree: ttk.Treeview, on_change):
+    _queue_instance_action('start', instance.config.id, tree, on_change)
+
+
+def stop_ec2_instance(instance: EC2InstanceStatus, tree: ttk.Treeview, on_change):
+    _queue_instance_action('stop', instance.config.id, tree, on_change)
+
+
+_last_values: dict[str, tuple] = {}
 
 def init_treeview(tree: ttk.Treeview, config: EC2InstanceConfigCollection):
     for instance in config.values():
-        tree.insert('', 'end', instance.id, values=(
+        values = (
             instance.id,
             instance.display_name,
             '',
             '',
             ''
-        ))
+        )
+        tree.insert('', 'end', iid=instance.id, values=values)
+        _last_values[instance.id] = values
 
 def update_treeview(
-    states: EC2InstanceStatusCollection,
+    snapshot: EC2InstanceStatusSnapshot,
     tree: ttk.Treeview
 ):
-    for instance in states.values():
-        tree.item(instance.id, values=(
+    current_time = datetime.now(timezone.utc)
+    for instance in snapshot:
+        values = (
             instance.id,
             instance.name,
             instance.state,
             instance.public_ip if instance.public_ip else '',
-            format_elapsed_time(instance.elapsed_time)
-        ))
+            format_elapsed_time(current_time - instance.launch_time if instance.launch_time else None)
+        )
+        last_values = _last_values.get(instance.id, ())
+        # 変化したセルだけ書き換える
+        for column, value in enumerate(values, 1):
+            if column > len(last_values) or last_values[column - 1] != value:
+                tree.set(instance.id, column=column, value=value)
+        _last_values[instance.id] = values
+
+def update_treeview_elapsed_time(
+    snapshot: EC2InstanceStatusSnapshot,
+    tree: ttk.Treeview
+):
+    # 経過時間の列だけを、起動中のインスタンスについてのみ更新する
+    current_time = datetime.now(timezone.utc)
+    for instance in snapshot:
+        if instance.state != 'running' or instance.launch_time is None:
+            continue
+        value = format_elapsed_time(current_time - instance.launch_time)
+        last_values = _last_values[instance.id]
+        if last_values[4] != value:
+            tree.set(instance.id, column=5, value=value)
+            _last_values[instance.id] = last_values[:4] + (value,)
+
+# 最新の状態一覧。要素は frozen な EC2InstanceStatus のタプルで、Tk のスレッドで丸ごと差し替えるだけなので、
+# 読む側は参照を一度取り出せばロックなしで一貫した状態を見られる
+_snapshot: EC2InstanceStatusSnapshot = ()
+
+# 取得を始めた順番。後から始めた取得の結果を、先に始めた取得の結果で上書きしないために使う
+_fetch_seq = 0
+_published_seq = 0
+
+# ウィンドウを閉じた後に、バックグラウンドのスレッドが Tk を触らないようにする
+_stop = threading.Event()
+
+def post_to_tk(tree: ttk.Treeview, callback):
+    # 別スレッドから Tk のスレッドに処理を渡す。閉じる途中で Tk が使えなくなっていれば何もしない
+    if _stop.is_set():
+        return
+    try:
+        tree.after(0, callback)
+    except (RuntimeError, tk.TclError):
+        pass
+
+def find_instance_state(snapshot: EC2InstanceStatusSnapshot, id: str) -> EC2InstanceStatus | None:
+    return next((instance for instance in snapshot if instance.id == id), None)
 
 def update_instance_status(
     config: EC2InstanceConfigCollection,
-    states: EC2InstanceStatusCollection,
-    tree: ttk.Treeview
+    tree: ttk.Treeview,
+    on_updated=None
 ):
-    new_states = get_ec2_instance_states(config)
-    for instance in new_states.values():
-        states[instance.id] = instance
-    update_treeview(states, tree)
+    global _fetch_seq
+    _fetch_seq += 1
+    seq = _fetch_seq
+
+    # 通信だけを別スレッドで行い、ビューの更新は Tk のスレッドに戻して行う
+    def worker():
+        try:
+            new_states = get_ec2_instance_states(config)
+        except Exception:
+            traceback.print_exc()
+            new_states = None
+        post_to_tk(tree, lambda: publish_instance_status(seq, new_states, tree, on_updated))
+    threading.Thread(target=worker, daemon=True).start()
+
+def publish_instance_status(
+    seq: int,
+    new_states: EC2InstanceStatusCollection | None,
+    tree: ttk.Treeview,
+    on_updated=None
+):
+    global _snapshot, _published_seq
+    if seq <= _published_seq:
+        # 後から始めた取得の結果がもう出ているので捨てる。間隔は進めずに次の更新だけ予約する
+        if on_updated:
+            on_updated(False, backoff=False)
+        return
+    changed = False
+    if new_states is not None:
+        _published_seq = seq
+        states = {instance.id: instance for instance in _snapshot}
+        changed = any(
+            instance.id in states and states[instance.id].state != instance.state
+            for instance in new_states.values()
+        )
+        states.update(new_states)
+        _snapshot = tuple(states.values())
+        update_treeview(_snapshot, tree)
+    if on_updated:
+        on_updated(changed)
+
+REFRESH_INTERVAL_MIN_MS = 2000
+REFRESH_INTERVAL_MAX_MS = 60000
+
+_pending_refresh = None
+_refresh_interval_ms = REFRESH_INTERVAL_MAX_MS
 
-continue_watching = True
-status_watching_burst = 0
-status_watching_immidiate = False
+def burst_status_watching():
+    global _refresh_interval_ms
+    _refresh_interval_ms = REFRESH_INTERVAL_MIN_MS
 
-def status_watching_worker(
+def schedule_refresh(
     config: EC2InstanceConfigCollection,
-    states: EC2InstanceStatusCollection,
     tree: ttk.Treeview,
-    default_interval=60,
-    burst_interval=6
+    delay_ms=300
 ):
-    update_instance_status(config, states, tree)
-    global status_watching_burst, status_watching_immidiate
-    tick = 0
-    while continue_watching:
-        interval = default_interval if status_watching_burst <= 0 else burst_interval
-        tick += 1
-        if tick % interval == 0 or status_watching_immidiate:
-            update_instance_status(config, states, tree)
-            status_watching_burst -= 1 if status_watching_burst > 0 else 0
-            status_watching_immidiate = False
-        else:
-            for instance in states.values():
-                if instance.elapsed_time:
-                    instance.elapsed_time += timedelta(seconds=1)
-            update_treeview(states, tree)
-        time.sleep(1)
-
+    global _pending_refresh
+    if _pending_refresh is not None:
+        tree.after_cancel(_pending_refresh)
+
+    def do_refresh():
+        global _pending_refresh
+        _pending_refresh = None
+        update_instance_status(config, tree, on_updated)
+
+    def on_updated(changed, backoff=True):
+        # 変化があれば短い間隔に戻し、変化がなければ最大間隔まで倍々に延ばす。
+        # 起動・停止の遷移中はウェイターが完了を知らせてくれるので、間隔は縮めない。
+        # 取得に失敗したときも、エラーが続く間は問い合わせを減らすよう倍にする
+        global _refresh_interval_ms
+        if changed and not _active_waiters:
+            _refresh_interval_ms = REFRESH_INTERVAL_MIN_MS
+        # 上限に張り付いても複数のアプリの問い合わせがそろわないよう、揺らぎは上限の前後にかける
+        delay = _refresh_interval_ms * random.uniform(0.85, 1.15)
+        if backoff:
+            _refresh_interval_ms = min(_refresh_interval_ms * 2, REFRESH_INTERVAL_MAX_MS)
+        if _pending_refresh is None:
+            schedule_refresh(config, tree, int(delay))
+
+    _pending_refresh = tree.after(delay_ms, do_refresh)
+
+def start_status_watching(
+    config: EC2InstanceConfigCollection,
+    tree: ttk.Treeview
+):
+    def tick():
+        update_treeview_elapsed_time(_snapshot, tree)
+        tree.after(1000, tick)
 
-def burst_status_watching():
-    global status_watching_burst, status_watching_immidiate
-    status_watching_burst = 10
-    status_watching_immidiate = True
+    schedule_refresh(config, tree, 0)
+    tree.after(1000, tick)
 
 
 if __name__ == "__main__":
@@ -223,7 +245,6 @@ if __name__ == "__main__":
     args = arg_parser.parse_args()
 
     ec2_configs = get_ec2_instance_configs(args.config)
-    ec2_states = OrderedDict()
 
     root = tk.Tk()
     root.title("EC2 Power Switch")
@@ -237,6 +258,7 @@ if __name__ == "__main__":
     tree.heading(3, text="状態")
     tree.heading(4, text="IPアドレス")
     tree.heading(5, text="経過時間")
+    # 行をすべて追加してから pack して、レイアウトを一度で済ませる
     init_treeview(tree, ec2_configs)
     tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
@@ -244,8 +266,7 @@ if __name__ == "__main__":
         sel = tree.selection()
         if not sel:
             return None
-        s = ec2_states[tree.item(sel[0], 'values')[0]]
-        return s
+        return find_instance_state(_snapshot, tree.item(sel[0], 'values')[0])
 
     def do_with_selected_instance(func):
         def wrapper():
@@ -254,18 +275,28 @@ if __name__ == "__main__":
                 func(s)
         return wrapper
 
+    def refresh_instance_status(burst=False):
+        def refresh():
+            if burst:
+                burst_status_watching()
+            schedule_refresh(ec2_configs, tree)
+        post_to_tk(tree, refresh)
+
     menu = tk.Menu(root, tearoff=0)
-    menu.add_command(label="起動", command=do_with_selected_instance(start_ec2_instance))
-    menu.add_command(label="停止", command=do_with_selected_instance(stop_ec2_instance))
+    menu.add_command(label="起動", command=do_with_selected_instance(lambda s: start_ec2_instance(s, tree, refresh_instance_status)))
+    menu.add_command(label="停止", command=do_with_selected_instance(lambda s: stop_ec2_instance(s, tree, refresh_instance_status)))
     menu.add_command(label="VSCode Remote SSH", command=do_with_selected_instance(open_vscode_remote_ssh))
     menu.add_separator()
-    menu.add_command(label="更新", command=lambda: update_instance_status(ec2_configs, ec2_states, tree))
+    menu.add_command(label="更新", command=lambda: refresh_instance_status(burst=True))
 
     def show_menu(e):
         item = tree.identify_row(e.y)
         if item:
             tree.selection_set(item)
-            actions = possible_actions(selected_instance_state())
+            s = selected_instance_state()
+            if not s:
+                return
+            actions = possible_actions(s)
             menu.entryconfig(0, state=tk.NORMAL if actions['start'] else tk.DISABLED)
             menu.entryconfig(1, state=tk.NORMAL if actions['stop'] else tk.DISABLED)
             menu.entryconfig(2, state=tk.NORMAL if actions['vscode'] else tk.DISABLED)
@@ -273,14 +304,13 @@ if __name__ == "__main__":
 
     tree.bind("<Button-2>", show_menu)
 
-    # update_instance_status(ec2_configs, ec2_states, tree)
-    thread = threading.Thread(
-        target=status_watching_worker,
-        args=(ec2_configs, ec2_states, tree, 60, 6)
-    )
-    thread.start()
+    start_status_watching(ec2_configs, tree)
 
-    root.mainloop()
+    def close():
+        # ウィンドウを壊す前に止めておかないと、その間に終わったスレッドが Tk を触ってしまう
+        _stop.set()
+        root.destroy()
 
-    continue_watching = False
-    thread.join()
+    root.protocol("WM_DELETE_WINDOW", close)
+
+    root.mainloop()